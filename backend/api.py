@@ -1,20 +1,19 @@
 import hashlib
 import requests
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, monitoring
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Cookie, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 from bson import ObjectId
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 import certifi
-import openai
 import tempfile
 from openai import OpenAI
 from pydub import AudioSegment
@@ -25,19 +24,26 @@ from groq import Groq
 import asyncio
 import re
 import secrets
-from pydantic import BaseModel
-
+import threading
+import math
+import contextvars
+import functools
+import random
+import sys
+import numpy as np
+import shutil
+import fnmatch
+from email.utils import format_datetime
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from gridfs import GridFSBucket
 
-AudioSegment.converter = which("ffmpeg") 
-AudioSegment.ffprobe = which("ffprobe")
 
 # Define the directory path where you want to save the audio files
 audio_directory = os.path.join(os.getcwd(), "src", "audio")
 
-# Ensure the audio directory exists
-if not os.path.exists(audio_directory):
-    os.makedirs(audio_directory)
-
 # Model used to Capture user sign up credentials.
 class UserCreate(BaseModel):
     username: str
@@ -85,28 +91,616 @@ class UpdatePasswordRequest(BaseModel):
     current_password: str
     new_password: str
 
-# loading the env variables and starting the fastapi
+# loading the env variables. Nothing below touches the network at import time,
+# so the module can be imported by a process manager before it forks workers.
 load_dotenv()
-fast_app = FastAPI()
-
-fast_app.mount("/audio", StaticFiles(directory="src/audio"), name="audio")
 
-# connect to database (mongoDB)
 MONGO_URI = os.getenv("MONGO_URI")
 NEWS_API_KEY = os.getenv("NEWS_API_KEY")
-print(f"Backend API Key: {NEWS_API_KEY}")
-openai.api_key = os.getenv("openai.api_key")
-client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
-db = client['news_app']
-users_collection = db['users']
-news_articles_collection = db['news_articles']
-grok_api_key = os.environ.get("GROQ_API_KEY")
-grok_client = Groq(api_key=grok_api_key)
-
-temp_users_collection = db['temp_users']
-# uniqueness of email and username maintained
-users_collection.create_index([("email", 1)], unique=True)
-users_collection.create_index([("username", 1)], unique=True)
+OPENAI_API_KEY = os.getenv("openai.api_key")
+GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+# When enabled, clients are built and Mongo is pinged before the worker accepts traffic
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", "false").lower() == "true"
+# Longest pause between attempts to create the indexes
+INDEX_RETRY_MAX_SECONDS = int(os.getenv("INDEX_RETRY_MAX_SECONDS", "60"))
+
+# Where finished podcasts live: "local" (audio_directory) or "gridfs" (shared by all nodes)
+AUDIO_STORAGE_BACKEND = os.getenv("AUDIO_STORAGE_BACKEND", "local").lower()
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "inboxzing_audio_cache"))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+AUDIO_GC_INTERVAL_SECONDS = int(os.getenv("AUDIO_GC_INTERVAL_SECONDS", "3600"))
+# Intermediates older than this are assumed to belong to a crashed or finished request
+AUDIO_INTERMEDIATE_MAX_AGE_SECONDS = int(os.getenv("AUDIO_INTERMEDIATE_MAX_AGE_SECONDS", "3600"))
+PODCAST_MAX_AGE_HOURS = int(os.getenv("PODCAST_MAX_AGE_HOURS", "72"))
+
+# Two articles whose 64-bit SimHash fingerprints differ in at most this many bits are the same story
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "7"))
+# How long a story stays in the shared index (and its summaries stay reusable)
+STORY_INDEX_TTL_HOURS = int(os.getenv("STORY_INDEX_TTL_HOURS", "48"))
+
+# Number of headlines requested from NewsAPI in one call (its maximum pageSize is 100)
+NEWS_CANDIDATE_POOL_SIZE = int(os.getenv("NEWS_CANDIDATE_POOL_SIZE", "50"))
+FEED_SIZE = 10
+# Background refresh of stale feeds for all users, in seconds (0 disables it)
+FEED_REFRESH_INTERVAL_SECONDS = int(os.getenv("FEED_REFRESH_INTERVAL_SECONDS", "0"))
+
+# Latency SLO mode for /news: serve the stored feed while refreshing it in the background,
+# and never spend more than FEED_DEADLINE_SECONDS building a feed for a user who has none
+FEED_SLO_MODE = os.getenv("FEED_SLO_MODE", "true").lower() == "true"
+FEED_DEADLINE_SECONDS = float(os.getenv("FEED_DEADLINE_SECONDS", "8"))
+NEWS_API_TIMEOUT_SECONDS = float(os.getenv("NEWS_API_TIMEOUT_SECONDS", "5"))
+# Consecutive failures that open a circuit, and how long it stays open before a trial call
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# Fleet-wide budgets for each provider, and per-process limits on calls in flight
+PROVIDER_LIMITS = {
+    "groq": {
+        "per_minute": float(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30")),
+        "burst": float(os.getenv("GROQ_BURST", "10")),
+        "concurrency": int(os.getenv("GROQ_CONCURRENCY", "4")),
+    },
+    "openai_chat": {
+        "per_minute": float(os.getenv("OPENAI_CHAT_REQUESTS_PER_MINUTE", "20")),
+        "burst": float(os.getenv("OPENAI_CHAT_BURST", "5")),
+        "concurrency": int(os.getenv("OPENAI_CHAT_CONCURRENCY", "2")),
+    },
+    "openai_tts": {
+        "per_minute": float(os.getenv("OPENAI_TTS_REQUESTS_PER_MINUTE", "10")),
+        "burst": float(os.getenv("OPENAI_TTS_BURST", "3")),
+        "concurrency": int(os.getenv("OPENAI_TTS_CONCURRENCY", "2")),
+    },
+}
+# Per-user budgets: all LLM/TTS calls made for a user, and podcast generations
+USER_LIMITS = {
+    "llm": {
+        "per_minute": float(os.getenv("USER_LLM_REQUESTS_PER_MINUTE", "20")),
+        "burst": float(os.getenv("USER_LLM_BURST", "12")),
+    },
+    "podcast": {
+        "per_minute": float(os.getenv("USER_PODCASTS_PER_HOUR", "4")) / 60,
+        "burst": float(os.getenv("USER_PODCAST_BURST", "2")),
+    },
+}
+# Draft the podcast after each feed refresh: "off", "script" or "audio" (script plus TTS and mixing)
+PODCAST_PREGENERATION = os.getenv("PODCAST_PREGENERATION", "off").lower()
+PODCAST_PREGENERATION_CONCURRENCY = int(os.getenv("PODCAST_PREGENERATION_CONCURRENCY", "1"))
+# How long opening the podcast waits for a running pre-generation job before making it itself
+PODCAST_TAKEOVER_WAIT_SECONDS = float(os.getenv("PODCAST_TAKEOVER_WAIT_SECONDS", "30"))
+
+# Request profiling: sampled fraction of requests to PROFILE_PATHS, and the token that
+# both forces profiling of a request (X-Profile-Token header) and unlocks /admin/profiles
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_PATHS = [path for path in os.getenv("PROFILE_PATHS", "/login,/podcast_script,/news").split(",") if path]
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "10"))
+PROFILE_COLLECTION_BYTES = int(os.getenv("PROFILE_COLLECTION_BYTES", str(64 * 1024 * 1024)))
+PROFILE_MAX_STACKS = 50
+PROFILE_MAX_STACK_DEPTH = 40
+
+# Share of each bucket kept for interactive requests
+BACKGROUND_RESERVE_FRACTION = float(os.getenv("BACKGROUND_RESERVE_FRACTION", "0.3"))
+# Longest a call may queue for a token or slot before it is shed
+ADMISSION_MAX_WAIT_SECONDS = {
+    "interactive": float(os.getenv("INTERACTIVE_MAX_WAIT_SECONDS", "5")),
+    "background": float(os.getenv("BACKGROUND_MAX_WAIT_SECONDS", "60")),
+}
+# Threads for blocking background work, kept apart from the default executor used by requests
+BACKGROUND_WORKER_THREADS = int(os.getenv("BACKGROUND_WORKER_THREADS", "4"))
+
+
+# Holds the database and API clients for the current process.
+# Clients are created on first use and rebuilt after a fork, because
+# MongoClient must not be shared between a parent and its forked workers.
+class ResourceContainer:
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._mongo_client = None
+        self._groq_client = None
+        self._openai_client = None
+        self._background_executor = None
+        self._audio_tools_ready = False
+        self._profiles_capped = False
+        self.indexes_ready = False
+
+    def _check_pid(self):
+        # A forked child inherits the parent's objects; drop them (without closing
+        # the parent's sockets) so this process opens its own connections.
+        if self._pid != os.getpid():
+            self._reset()
+
+    @property
+    def mongo_client(self) -> MongoClient:
+        self._check_pid()
+        if self._mongo_client is None:
+            with self._lock:
+                if self._mongo_client is None:
+                    self._mongo_client = MongoClient(
+                        MONGO_URI,
+                        tlsCAFile=certifi.where(),
+                        connect=False,
+                        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                        event_listeners=[MongoProfileListener()],
+                    )
+        return self._mongo_client
+
+    @property
+    def db(self):
+        return self.mongo_client['news_app']
+
+    @property
+    def users_collection(self):
+        return self.db['users']
+
+    @property
+    def news_articles_collection(self):
+        return self.db['news_articles']
+
+    @property
+    def temp_users_collection(self):
+        return self.db['temp_users']
+
+    @property
+    def story_index_collection(self):
+        return self.db['story_index']
+
+    @property
+    def engagement_collection(self):
+        return self.db['user_engagement']
+
+    @property
+    def rate_limits_collection(self):
+        return self.db['rate_limits']
+
+    @property
+    def profiles_collection(self):
+        return self.db['request_profiles']
+
+    @property
+    def groq_client(self) -> Groq:
+        self._check_pid()
+        if self._groq_client is None:
+            with self._lock:
+                if self._groq_client is None:
+                    self._groq_client = Groq(api_key=GROQ_API_KEY)
+        return self._groq_client
+
+    @property
+    def openai_client(self) -> OpenAI:
+        self._check_pid()
+        if self._openai_client is None:
+            with self._lock:
+                if self._openai_client is None:
+                    self._openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        return self._openai_client
+
+    @property
+    def background_executor(self) -> ThreadPoolExecutor:
+        self._check_pid()
+        if self._background_executor is None:
+            with self._lock:
+                if self._background_executor is None:
+                    self._background_executor = ThreadPoolExecutor(
+                        max_workers=BACKGROUND_WORKER_THREADS, thread_name_prefix="background"
+                    )
+        return self._background_executor
+
+    def ensure_audio_tools(self):
+        # Resolving ffmpeg walks the PATH, so only do it once something needs pydub
+        self._check_pid()
+        if not self._audio_tools_ready:
+            AudioSegment.converter = which("ffmpeg")
+            AudioSegment.ffprobe = which("ffprobe")
+            self._audio_tools_ready = True
+
+    def index_specs(self) -> list:
+        return [
+            # uniqueness of email and username maintained
+            (self.users_collection, [("email", 1)], {"unique": True}),
+            (self.users_collection, [("username", 1)], {"unique": True}),
+            # near-duplicate lookups go through the LSH bands; old stories expire on their own
+            (self.story_index_collection, [("bands", 1)], {}),
+            (self.story_index_collection, [("sources.url", 1)], {}),
+            (self.story_index_collection, [("seen_at", 1)], {"expireAfterSeconds": STORY_INDEX_TTL_HOURS * 3600}),
+            # record_story upserts by url; articles without one are never matched by url
+            (self.story_index_collection, [("url", 1)], {
+                "unique": True, "partialFilterExpression": {"url": {"$type": "string"}},
+            }),
+            # idle buckets (mostly per-user ones) are dropped after a day
+            (self.rate_limits_collection, [("updated_at", 1)], {"expireAfterSeconds": 24 * 3600}),
+        ]
+
+    # Stories recorded before url was unique may share a url; keep the most recently seen one
+    def remove_duplicate_story_urls(self):
+        duplicates = self.story_index_collection.aggregate([
+            {"$match": {"url": {"$type": "string"}}},
+            {"$sort": {"seen_at": -1}},
+            {"$group": {"_id": "$url", "ids": {"$push": "$_id"}}},
+            {"$match": {"ids.1": {"$exists": True}}},
+        ])
+        for duplicate in duplicates:
+            self.story_index_collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+
+    # Creates every index, each one even if another fails; raises if any is still missing
+    def ensure_indexes(self):
+        failures = []
+        try:
+            self.remove_duplicate_story_urls()
+        except Exception as e:
+            failures.append(f"story_index duplicates: {e}")
+        for collection, keys, options in self.index_specs():
+            try:
+                collection.create_index(keys, **options)
+            except Exception as e:
+                failures.append(f"{collection.name} {keys}: {e}")
+        if failures:
+            raise RuntimeError("Could not create indexes: " + "; ".join(failures))
+        self.indexes_ready = True
+
+    # Request profiles are kept in a capped collection, so old ones roll off. A collection
+    # created uncapped (by an insert before this ran) is converted in place.
+    def ensure_profiles_collection(self):
+        self._check_pid()
+        if self._profiles_capped:
+            return
+        try:
+            self.db.create_collection("request_profiles", capped=True, size=PROFILE_COLLECTION_BYTES)
+        except CollectionInvalid:
+            if not self.profiles_collection.options().get("capped"):
+                self.db.command("convertToCapped", "request_profiles", size=PROFILE_COLLECTION_BYTES)
+        self._profiles_capped = True
+
+    def ping(self):
+        self.mongo_client.admin.command("ping")
+
+    def warm_up(self):
+        self.ping()
+        self.ensure_indexes()
+        self.groq_client
+        self.openai_client
+        self.ensure_audio_tools()
+
+    def close(self):
+        if self._mongo_client is not None and self._pid == os.getpid():
+            self._mongo_client.close()
+        if self._background_executor is not None and self._pid == os.getpid():
+            self._background_executor.shutdown(wait=False, cancel_futures=True)
+        self._reset()
+
+
+resources = ResourceContainer()
+
+# The worker's event loop, so background jobs can be scheduled from worker threads
+event_loop = None
+
+
+# Blob storage for podcast audio.
+# Every backend exposes the same small interface: exists, save (from a local file),
+# delete, stat, list and local_path (a file on this node that can be streamed).
+
+# Metadata describing one stored audio file (modified_at is timezone-aware UTC)
+class AudioBlob(BaseModel):
+    name: str
+    size: int
+    etag: str
+    modified_at: datetime
+
+
+PODCAST_FILE_PATTERN = "*_final_podcast_audio.wav"
+# "*_podcast_audio.wav" is the name older versions used for the converted TTS audio
+INTERMEDIATE_FILE_PATTERNS = ["podcast_audio_*.mp3", "*_tts_*.wav", "*_podcast_audio.wav", "*_mix_*.wav"]
+AUDIO_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def is_intermediate_file(name: str) -> bool:
+    # Finished podcasts also end in "_podcast_audio.wav" and usernames may contain "_tts_"
+    # or "_mix_", so anything named like a podcast is never an intermediate
+    if fnmatch.fnmatch(name, PODCAST_FILE_PATTERN):
+        return False
+    return any(fnmatch.fnmatch(name, pattern) for pattern in INTERMEDIATE_FILE_PATTERNS)
+
+
+def podcast_file_name(username: str) -> str:
+    return f"{username}_final_podcast_audio.wav"
+
+
+def file_sha1(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Stores podcasts on this node's disk (the original behaviour)
+class LocalAudioStorage:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def save(self, name: str, source_path: str) -> AudioBlob:
+        os.makedirs(self.directory, exist_ok=True)
+        target = self._path(name)
+        if os.path.abspath(source_path) != os.path.abspath(target):
+            # Write next to the target then rename, so readers never see a half-written file
+            tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, target)
+        return self.stat(name)
+
+    def delete(self, name: str) -> bool:
+        try:
+            os.remove(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stat(self, name: str) -> Optional[AudioBlob]:
+        try:
+            st = os.stat(self._path(name))
+        except FileNotFoundError:
+            return None
+        return AudioBlob(
+            name=name,
+            size=st.st_size,
+            etag=f"{st.st_size:x}-{st.st_mtime_ns:x}",
+            modified_at=datetime.fromtimestamp(st.st_mtime, timezone.utc),
+        )
+
+    def list(self, pattern: str = "*") -> List[AudioBlob]:
+        if not os.path.isdir(self.directory):
+            return []
+        blobs = []
+        for name in os.listdir(self.directory):
+            if fnmatch.fnmatch(name, pattern):
+                blob = self.stat(name)
+                if blob:
+                    blobs.append(blob)
+        return blobs
+
+    def local_path(self, name: str) -> Optional[str]:
+        path = self._path(name)
+        return path if os.path.exists(path) else None
+
+
+# Keeps recently served blobs from a remote backend on this node's disk.
+# Entries are keyed by etag, so a regenerated podcast never serves a stale copy.
+class AudioReadCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, name: str, etag: str) -> str:
+        return os.path.join(self.directory, f"{etag}_{name}")
+
+    def get(self, name: str, etag: str) -> Optional[str]:
+        path = self._path(name, etag)
+        if os.path.exists(path):
+            # Touch so pruning evicts the least recently served files first
+            os.utime(path, None)
+            return path
+        return None
+
+    def put(self, name: str, etag: str, write_to) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(name, etag)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            write_to(f)
+        os.replace(tmp_path, path)
+        self.prune()
+        return path
+
+    def evict(self, name: str):
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.listdir(self.directory):
+            if entry.endswith(f"_{name}"):
+                try:
+                    os.remove(os.path.join(self.directory, entry))
+                except FileNotFoundError:
+                    pass
+
+    def prune(self):
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                return
+            entries = []
+            for entry in os.listdir(self.directory):
+                path = os.path.join(self.directory, entry)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+
+# Stores podcasts in MongoDB GridFS so every node behind the load balancer sees them
+class GridFSAudioStorage:
+    def __init__(self, bucket_name: str, cache: AudioReadCache):
+        self.bucket_name = bucket_name
+        self.cache = cache
+
+    @property
+    def bucket(self) -> GridFSBucket:
+        # Built per call from the per-process database handle, so it is fork-safe too
+        return GridFSBucket(resources.db, bucket_name=self.bucket_name)
+
+    @property
+    def files_collection(self):
+        return resources.db[f"{self.bucket_name}.files"]
+
+    def _latest(self, name: str) -> Optional[dict]:
+        return self.files_collection.find_one({"filename": name}, sort=[("uploadDate", -1)])
+
+    def _to_blob(self, doc: dict) -> AudioBlob:
+        return AudioBlob(
+            name=doc["filename"],
+            size=doc["length"],
+            etag=(doc.get("metadata") or {}).get("etag", str(doc["_id"])),
+            # GridFS records uploadDate as naive UTC
+            modified_at=doc["uploadDate"].replace(tzinfo=timezone.utc),
+        )
+
+    def exists(self, name: str) -> bool:
+        return self.files_collection.count_documents({"filename": name}, limit=1) > 0
+
+    def save(self, name: str, source_path: str) -> AudioBlob:
+        etag = file_sha1(source_path)
+        with open(source_path, "rb") as f:
+            new_id = self.bucket.upload_from_stream(name, f, metadata={"etag": etag})
+        # Remove older revisions only after the new one is fully uploaded
+        for doc in self.files_collection.find({"filename": name, "_id": {"$ne": new_id}}, {"_id": 1}):
+            self.bucket.delete(doc["_id"])
+        # Seed this node's cache with the file we already have on disk
+        def copy_source(out):
+            with open(source_path, "rb") as src:
+                shutil.copyfileobj(src, out)
+        self.cache.put(name, etag, copy_source)
+        return self.stat(name)
+
+    def delete(self, name: str) -> bool:
+        deleted = False
+        for doc in self.files_collection.find({"filename": name}, {"_id": 1}):
+            self.bucket.delete(doc["_id"])
+            deleted = True
+        self.cache.evict(name)
+        return deleted
+
+    def stat(self, name: str) -> Optional[AudioBlob]:
+        doc = self._latest(name)
+        return self._to_blob(doc) if doc else None
+
+    def list(self, pattern: str = "*") -> List[AudioBlob]:
+        return [
+            self._to_blob(doc)
+            for doc in self.files_collection.find({}, {"filename": 1, "length": 1, "uploadDate": 1, "metadata": 1})
+            if fnmatch.fnmatch(doc["filename"], pattern)
+        ]
+
+    def local_path(self, name: str) -> Optional[str]:
+        doc = self._latest(name)
+        if not doc:
+            return None
+        blob = self._to_blob(doc)
+        cached = self.cache.get(name, blob.etag)
+        if cached:
+            return cached
+        return self.cache.put(name, blob.etag, lambda out: self.bucket.download_to_stream(doc["_id"], out))
+
+
+def build_audio_storage():
+    if AUDIO_STORAGE_BACKEND == "gridfs":
+        return GridFSAudioStorage("podcast_audio", AudioReadCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES))
+    return LocalAudioStorage(audio_directory)
+
+
+audio_storage = build_audio_storage()
+
+
+# Removes orphaned intermediates on this node and stale podcasts from storage.
+# Podcasts are stale when their user no longer exists or they are older than PODCAST_MAX_AGE_HOURS.
+def collect_audio_garbage() -> dict:
+    removed = {"intermediates": 0, "podcasts": 0}
+    now = time.time()
+    if os.path.isdir(audio_directory):
+        for name in os.listdir(audio_directory):
+            if not is_intermediate_file(name):
+                continue
+            path = os.path.join(audio_directory, name)
+            try:
+                if now - os.path.getmtime(path) > AUDIO_INTERMEDIATE_MAX_AGE_SECONDS:
+                    os.remove(path)
+                    removed["intermediates"] += 1
+            except FileNotFoundError:
+                pass
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=PODCAST_MAX_AGE_HOURS)
+    podcasts = audio_storage.list(PODCAST_FILE_PATTERN)
+    usernames = [blob.name[: -len("_final_podcast_audio.wav")] for blob in podcasts]
+    existing = {
+        user["username"]
+        for user in resources.users_collection.find({"username": {"$in": usernames}}, {"username": 1})
+    } if usernames else set()
+    for blob, username in zip(podcasts, usernames):
+        if username not in existing or blob.modified_at < cutoff:
+            if audio_storage.delete(blob.name):
+                removed["podcasts"] += 1
+    return removed
+
+
+async def run_audio_garbage_collector():
+    while True:
+        try:
+            removed = await asyncio.to_thread(collect_audio_garbage)
+            if removed["intermediates"] or removed["podcasts"]:
+                print(f"Audio GC removed {removed}")
+        except Exception as e:
+            print(f"Error during audio garbage collection: {e}")
+        await asyncio.sleep(AUDIO_GC_INTERVAL_SECONDS)
+
+
+# Retries until every index exists; the worker reports not ready until then
+async def _ensure_indexes_in_background():
+    delay = 1
+    while not resources.indexes_ready:
+        try:
+            await asyncio.to_thread(resources.ensure_indexes)
+        except Exception as e:
+            print(f"Error creating indexes, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, INDEX_RETRY_MAX_SECONDS)
+
+
+# Startup and shutdown for each worker process
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global event_loop
+    started = time.perf_counter()
+    event_loop = asyncio.get_running_loop()
+    os.makedirs(audio_directory, exist_ok=True)
+    if WARM_UP_ON_STARTUP:
+        try:
+            await asyncio.to_thread(resources.warm_up)
+        except Exception as e:
+            print(f"Warm-up failed, continuing with lazy clients: {e}")
+    background_tasks = []
+    if not resources.indexes_ready:
+        background_tasks.append(asyncio.create_task(_ensure_indexes_in_background()))
+    if AUDIO_GC_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(run_audio_garbage_collector()))
+    if FEED_REFRESH_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(run_feed_refresher()))
+    print(f"Worker {os.getpid()} started in {time.perf_counter() - started:.3f}s")
+    yield
+    for task in background_tasks + list(feed_background_tasks.values()):
+        if not task.done():
+            task.cancel()
+    event_loop = None
+    resources.close()
+
+
+fast_app = FastAPI(lifespan=lifespan)
 
 NEWS_API_URL = "https://newsapi.org/v2/top-headlines"
 
@@ -118,39 +712,621 @@ def hash_password(password: str) -> str:
 def verify_password(stored_password: str, provided_password: str) -> bool:
     return stored_password == hash_password(provided_password)
 
-def fetch_news(preferences: UserPreferences) -> List[dict]:
-    articles = []
-    page = 1  # Start fetching from the first page
-
-    while len(articles) < 10:  # Keep fetching until we have 10 articles
-        params = {
-            'apiKey': NEWS_API_KEY,
-            'sources': preferences.sources,  # Use the sources parameter
-            'pageSize': 10,  # Fetch 10 articles per request
-            'page': page  # Fetch the next page
+# Request profiling.
+# A request is profiled when it hits one of PROFILE_PATHS and wins a PROFILE_SAMPLE_RATE
+# draw, or when it carries an X-Profile-Token header matching PROFILER_TOKEN. While any
+# request is profiled, a sampler thread records the stacks of the threads working for it
+# every PROFILE_SAMPLE_INTERVAL_MS. Time spent in Mongo (via a command listener), HTTP,
+# LLM, admission queueing, ffmpeg/pydub and storage is added up per stage. Finished
+# profiles go to a capped collection and can be browsed under /admin/profiles.
+# Requests that are not profiled pay for one random draw and a context variable lookup.
+active_profile = contextvars.ContextVar("active_profile", default=None)
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, trigger: str):
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.stacks = {}
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def enter_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+
+    def exit_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            count = self._threads.get(ident, 0) - 1
+            if count > 0:
+                self._threads[ident] = count
+            else:
+                self._threads.pop(ident, None)
+
+    def thread_ids(self) -> List[int]:
+        with self._lock:
+            return list(self._threads)
+
+    def add_stage(self, stage: str, seconds: float):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"ms": 0.0, "count": 0})
+            totals["ms"] += seconds * 1000
+            totals["count"] += 1
+
+    def add_stack(self, frame):
+        entries = []
+        while frame is not None and len(entries) < PROFILE_MAX_STACK_DEPTH:
+            code = frame.f_code
+            entries.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        # Collapsed format: outermost frame first, frames separated by ";"
+        key = ";".join(reversed(entries))
+        with self._lock:
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def to_document(self, status_code: int) -> dict:
+        with self._lock:
+            top_stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:PROFILE_MAX_STACKS]
+            return {
+                "method": self.method,
+                "path": self.path,
+                "status_code": status_code,
+                "trigger": self.trigger,
+                "pid": os.getpid(),
+                "started_at": self.started_at,
+                "duration_ms": (time.perf_counter() - self.started) * 1000,
+                "stages": {stage: dict(totals) for stage, totals in self.stages.items()},
+                "samples": self.samples,
+                "stacks": [{"stack": stack, "count": count} for stack, count in top_stacks],
+            }
+
+class StackSampler:
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._profiles = set()
+        self._thread = None
+
+    def start(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.add(profile)
+            # The thread stops when nothing is profiled, and does not survive a fork
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+
+    def stop(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                profiles = list(self._profiles)
+                if not profiles:
+                    self._thread = None
+                    return
+            frames = sys._current_frames()
+            for profile in profiles:
+                for ident in profile.thread_ids():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        profile.add_stack(frame)
+            del frames
+            time.sleep(self.interval_seconds)
+
+
+stack_sampler = StackSampler(PROFILE_SAMPLE_INTERVAL_MS / 1000)
+
+# Times a block of work as one stage of the current request's profile, if any
+@contextmanager
+def profile_stage(stage: str):
+    profile = active_profile.get()
+    if profile is None:
+        yield
+        return
+    profile.enter_thread()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_stage(stage, time.perf_counter() - started)
+        profile.exit_thread()
+
+# Adds the time of every MongoDB command to the "mongo" stage of the profile it ran under
+class MongoProfileListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def _record(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.add_stage("mongo", event.duration_micros / 1_000_000)
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+
+def should_profile(request: Request) -> Optional[str]:
+    token = request.headers.get("x-profile-token")
+    if token and PROFILER_TOKEN and secrets.compare_digest(token.encode(), PROFILER_TOKEN.encode()):
+        return "header"
+    if PROFILE_SAMPLE_RATE > 0 and any(request.url.path.startswith(path) for path in PROFILE_PATHS):
+        if random.random() < PROFILE_SAMPLE_RATE:
+            return "sampled"
+    return None
+
+profile_write_tasks = set()
+
+def save_profile(document: dict):
+    try:
+        # Never insert before the collection is capped, or the insert would create it uncapped
+        resources.ensure_profiles_collection()
+        resources.profiles_collection.insert_one(document)
+    except Exception as e:
+        print(f"Error saving request profile: {e}")
+
+def require_admin(request: Request):
+    token = request.headers.get("x-profile-token")
+    if not PROFILER_TOKEN or not token or not secrets.compare_digest(token.encode(), PROFILER_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+# Circuit breakers for upstream services.
+# After CIRCUIT_FAILURE_THRESHOLD consecutive failures a circuit opens and calls fail fast
+# with CircuitOpenError. After CIRCUIT_RESET_SECONDS one trial call is let through
+# (half-open): success closes the circuit, failure opens it again.
+class UpstreamUnavailableError(Exception):
+    pass
+
+class CircuitOpenError(UpstreamUnavailableError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_in_flight:
+                raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+            self._trial_in_flight = True
+
+    def _record(self, success: bool):
+        with self._lock:
+            self._trial_in_flight = False
+            if success:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"Circuit for {self.name} opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        self._before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True)
+        return result
+
+
+news_api_breaker = CircuitBreaker("NewsAPI")
+groq_breaker = CircuitBreaker("Groq")
+circuit_breakers = [news_api_breaker, groq_breaker]
+
+# Admission control for LLM and TTS work.
+# Every provider call takes a token from a fleet-wide token bucket kept in MongoDB
+# (refilled using the database clock, so all workers and nodes share one budget) and
+# a slot from this process's concurrency limit. Calls made on behalf of a user also
+# draw from that user's bucket. Background work (refreshes, backfills, digests) may
+# not dip into the last BACKGROUND_RESERVE_FRACTION of a bucket or the last
+# concurrency slot, so interactive requests go first. A caller waits for a token at
+# most its priority's queue budget; beyond that the work is shed with a 429.
+WORK_INTERACTIVE = "interactive"
+WORK_BACKGROUND = "background"
+work_priority = contextvars.ContextVar("work_priority", default=WORK_INTERACTIVE)
+work_username = contextvars.ContextVar("work_username", default=None)
+# Users waiting on their own background work (a podcast being pre-generated); from its next
+# provider call on, that work is admitted at interactive priority
+users_awaiting_background_work = set()
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(f"Too many requests for {key}, retry in {retry_after:.0f}s")
+        self.key = key
+        self.retry_after = retry_after
+
+class ConcurrencyGovernor:
+    def __init__(self, provider_limits: dict, user_limits: dict):
+        self.provider_limits = provider_limits
+        self.user_limits = user_limits
+        self._slots = {
+            provider: threading.BoundedSemaphore(limit["concurrency"])
+            for provider, limit in provider_limits.items()
+        }
+        self._background_slots = {
+            provider: threading.BoundedSemaphore(max(limit["concurrency"] - 1, 1))
+            for provider, limit in provider_limits.items()
         }
 
-        response = requests.get(NEWS_API_URL, params=params)
-        
-        if response.status_code == 200:
-            new_articles = response.json().get('articles', [])
-            
-            # Filter articles to ensure they have complete data
-            for article in new_articles:
-                if all(key in article and article[key] for key in ['title', 'description', 'urlToImage', 'content']):
-                    articles.append(article)
-                
-                # Stop if we already have 10 complete articles
-                if len(articles) >= 10:
-                    break
+    # Refills and takes one token in a single atomic update; returns seconds to wait (0 if granted)
+    def _try_take(self, key: str, limit: dict, reserve: float) -> float:
+        rate = limit["per_minute"] / 60.0
+        bucket = resources.rate_limits_collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": {"$min": [limit["burst"], {"$add": [
+                    {"$ifNull": ["$tokens", limit["burst"]]},
+                    {"$multiply": [rate, {"$divide": [
+                        {"$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]}, 1000,
+                    ]}]},
+                ]}]}, "updated_at": "$$NOW"}},
+                {"$set": {"granted": {"$gte": ["$tokens", 1 + reserve]}}},
+                {"$set": {"tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if bucket["granted"]:
+            return 0
+        return max((1 + reserve - bucket["tokens"]) / rate, 0.05)
+
+    def _take(self, key: str, limit: dict, priority: str, deadline: float):
+        reserve = limit["burst"] * BACKGROUND_RESERVE_FRACTION if priority == WORK_BACKGROUND else 0
+        while True:
+            try:
+                wait = self._try_take(key, limit, reserve)
+            except Exception as e:
+                # The limiter must not take the app down with it; let the call through
+                print(f"Rate limiter unavailable for {key}: {e}")
+                return
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                raise AdmissionRejectedError(key, wait)
+            time.sleep(wait)
+
+    # Holds a token and a concurrency slot for one call to a provider
+    @contextmanager
+    def admit(self, provider: str):
+        priority = work_priority.get()
+        username = work_username.get()
+        if priority == WORK_BACKGROUND and username in users_awaiting_background_work:
+            priority = WORK_INTERACTIVE
+        deadline = time.monotonic() + ADMISSION_MAX_WAIT_SECONDS[priority]
+        slots = [self._slots[provider]]
+        if priority == WORK_BACKGROUND:
+            slots.insert(0, self._background_slots[provider])
+        acquired = []
+        try:
+            with profile_stage("admission"):
+                if username:
+                    self._take(f"user:{username}:llm", self.user_limits["llm"], priority, deadline)
+                self._take(f"provider:{provider}", self.provider_limits[provider], priority, deadline)
+                for slot in slots:
+                    if not slot.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                        raise AdmissionRejectedError(f"provider:{provider}", 1)
+                    acquired.append(slot)
+            with profile_stage("llm"):
+                yield
+        finally:
+            for slot in reversed(acquired):
+                slot.release()
+
+    # Per-user limit on an expensive action; over the limit the request is rejected at once
+    def check_user_action(self, username: str, action: str):
+        self._take(f"user:{username}:{action}", self.user_limits[action], WORK_INTERACTIVE, time.monotonic())
+
+
+governor = ConcurrencyGovernor(PROVIDER_LIMITS, USER_LIMITS)
+
+# Runs a blocking call in a thread like asyncio.to_thread. Background work gets the bounded
+# background executor, so a job queueing for admission (which sleeps in its thread) never
+# holds a thread that an interactive request is waiting for.
+async def run_blocking(func, *args):
+    if work_priority.get() != WORK_BACKGROUND:
+        return await asyncio.to_thread(func, *args)
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(resources.background_executor, call)
+
+# Near-duplicate detection.
+# Each article gets a 64-bit SimHash over word 2-shingles of its title and content.
+# For locality-sensitive lookup the fingerprint is cut into NEAR_DUPLICATE_MAX_DISTANCE + 2
+# blocks, and every pair of blocks is a band key. Two fingerprints within the distance differ
+# in at most that many blocks, so at least two blocks (one band key) are identical. A key is
+# about 14 bits wide at the default distance, so unrelated stories rarely share one.
+SIMHASH_BITS = 64
+SIMHASH_BLOCKS = NEAR_DUPLICATE_MAX_DISTANCE + 2
+TRUNCATED_CONTENT_RE = re.compile(r"\s*\[\+\d+ chars\]\s*$")
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+def article_text(article: dict) -> str:
+    # NewsAPI truncates content and appends "[+1234 chars]", which differs between copies
+    content = TRUNCATED_CONTENT_RE.sub("", article.get("content") or "")
+    return f"{article.get('title') or ''} {content}".lower()
+
+def simhash(text: str, shingle_size: int = 2) -> int:
+    words = WORD_RE.findall(text)
+    shingles = [" ".join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))]
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+def article_fingerprint(article: dict) -> int:
+    if "fingerprint" not in article:
+        article["fingerprint"] = simhash(article_text(article))
+    return article["fingerprint"]
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def simhash_bands(fingerprint: int) -> List[str]:
+    bounds = [SIMHASH_BITS * block // SIMHASH_BLOCKS for block in range(SIMHASH_BLOCKS + 1)]
+    blocks = [fingerprint >> bounds[i] & ((1 << bounds[i + 1] - bounds[i]) - 1) for i in range(SIMHASH_BLOCKS)]
+    return [
+        f"{i},{j}:{blocks[i]:x}:{blocks[j]:x}"
+        for i in range(SIMHASH_BLOCKS) for j in range(i + 1, SIMHASH_BLOCKS)
+    ]
+
+def to_int64(value: int) -> int:
+    # BSON integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def from_int64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+# Higher is better: prefer copies with every field present, then the longest content
+def article_completeness(article: dict) -> tuple:
+    fields = ['title', 'description', 'urlToImage', 'content', 'publishedAt']
+    return (sum(1 for key in fields if article.get(key)), len(article_text(article)))
+
+def source_name(article: dict) -> str:
+    source = article.get("source") or {}
+    return source.get("name", "Unknown Source") if isinstance(source, dict) else str(source)
+
+# Groups near-duplicate articles, keeping the most complete copy of each story in the
+# position of its first occurrence. The other copies are listed in "alternateSources".
+def collapse_near_duplicates(articles: List[dict]) -> List[dict]:
+    clusters = []
+    for article in articles:
+        fingerprint = article_fingerprint(article)
+        for cluster in clusters:
+            if hamming_distance(fingerprint, article_fingerprint(cluster[0])) <= NEAR_DUPLICATE_MAX_DISTANCE:
+                cluster.append(article)
+                break
+        else:
+            clusters.append([article])
+
+    collapsed = []
+    for cluster in clusters:
+        best = max(cluster, key=article_completeness)
+        alternates = [{"source": source_name(a), "url": a.get("url")} for a in cluster if a is not best]
+        collapsed.append({**best, "alternateSources": alternates})
+    return collapsed
+
+# Finds the stored story for each article in the shared index (or None), using one query.
+# Only the fields the callers read are fetched: the fingerprint and the summary in this style.
+def match_story_index(articles: List[dict], summary_style: str) -> List[Optional[dict]]:
+    if not articles:
+        return []
+    fingerprints = [article_fingerprint(article) for article in articles]
+    bands = sorted({band for fingerprint in fingerprints for band in simhash_bands(fingerprint)})
+    candidates = list(resources.story_index_collection.find(
+        {"bands": {"$in": bands}}, {"simhash": 1, f"summaries.{summary_style}": 1}
+    ))
+    matches = []
+    for fingerprint in fingerprints:
+        best, best_distance = None, NEAR_DUPLICATE_MAX_DISTANCE + 1
+        for doc in candidates:
+            distance = hamming_distance(fingerprint, from_int64(doc["simhash"]))
+            if distance < best_distance:
+                best, best_distance = doc, distance
+        matches.append(best)
+    return matches
+
+# Records a story (and the summary just made for it, if any) in the shared index
+def record_story(article: dict, story: Optional[dict], summary_style: str, summary: Optional[str]):
+    sources = [{"source": source_name(article), "url": article.get("url")}] + article.get("alternateSources", [])
+    update = {
+        "$set": {"seen_at": datetime.now()},
+        "$addToSet": {"sources": {"$each": sources}},
+    }
+    if summary:
+        update["$set"][f"summaries.{summary_style}"] = summary
+    if story:
+        resources.story_index_collection.update_one({"_id": story["_id"]}, update)
+    else:
+        fingerprint = article_fingerprint(article)
+        update["$setOnInsert"] = {
+            "simhash": to_int64(fingerprint),
+            "bands": simhash_bands(fingerprint),
+            "title": article.get("title"),
+            "url": article.get("url"),
+            "content": article.get("content"),
+        }
+        try:
+            resources.story_index_collection.update_one({"url": article.get("url")}, update, upsert=True)
+        except DuplicateKeyError:
+            # Another request inserted the same url first; the retry updates its document
+            del update["$setOnInsert"]
+            resources.story_index_collection.update_one({"url": article.get("url")}, update)
+
+# Candidate ranking.
+# Each user's feed is the top FEED_SIZE candidates by a linear score over:
+#   recency     exp(-age / half-life) of the article's publish time
+#   affinity    how often and how long the user reads this source (smoothed towards a prior)
+#   completeness length of the available text, so fuller copies win ties
+# Affinity is trusted in proportion to how much history the user has.
+# Scores for many users are computed as one users x candidates matrix.
+RANKING_RECENCY_HALF_LIFE_HOURS = float(os.getenv("RANKING_RECENCY_HALF_LIFE_HOURS", "12"))
+RANKING_WEIGHTS = {"recency": 1.0, "affinity": 1.5, "completeness": 0.2}
+# Prior read rate for a source the user has never seen, and its strength in "articles shown"
+AFFINITY_PRIOR_RATE = 0.3
+AFFINITY_PRIOR_STRENGTH = 3.0
+# Seconds of reading per read article at which the reading-time signal reaches one half
+AFFINITY_READING_TIME_SCALE = 60.0
+# Articles shown to a user after which affinity is weighted at one half
+ENGAGEMENT_CONFIDENCE_SCALE = 20.0
+
+def source_key(name: str) -> str:
+    # Source names become Mongo field names, which may not contain dots or start with "$"
+    return re.sub(r"[.$]", "_", name or "Unknown Source")
+
+def parse_published_at(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        published = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return published.replace(tzinfo=None) if published.tzinfo is None else published.astimezone(tz=None).replace(tzinfo=None)
+
+# Recency and completeness for each candidate, plus the column of its source
+def candidate_features(candidates: List[dict], source_columns: dict):
+    now = datetime.now()
+    ages = np.array([
+        (now - published).total_seconds() / 3600 if published else 48.0
+        for published in (parse_published_at(c.get("publishedAt")) for c in candidates)
+    ])
+    recency = np.exp2(-np.clip(ages, 0, None) / RANKING_RECENCY_HALF_LIFE_HOURS)
+    lengths = np.array([len(article_text(c)) for c in candidates], dtype=float)
+    completeness = lengths / lengths.max() if len(lengths) and lengths.max() > 0 else np.zeros(len(candidates))
+    columns = np.array([source_columns[source_key(source_name(c))] for c in candidates], dtype=int)
+    return recency, completeness, columns
+
+# Per-user source affinity (users x sources) and confidence in it (users)
+def affinity_matrix(histories: List[dict], sources: List[str]):
+    shape = (len(histories), len(sources))
+    shown, read, reading_time = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    for row, history in enumerate(histories):
+        per_source = history.get("sources", {})
+        for column, source in enumerate(sources):
+            stats = per_source.get(source)
+            if stats:
+                shown[row, column] = stats.get("shown", 0)
+                read[row, column] = stats.get("read", 0)
+                reading_time[row, column] = stats.get("readingTime", 0)
+
+    read_rate = (read + AFFINITY_PRIOR_RATE * AFFINITY_PRIOR_STRENGTH) / (shown + AFFINITY_PRIOR_STRENGTH)
+    time_per_read = reading_time / np.maximum(read, 1)
+    time_signal = time_per_read / (time_per_read + AFFINITY_READING_TIME_SCALE)
+    affinity = 0.7 * np.clip(read_rate, 0, 1) + 0.3 * time_signal
+
+    total_shown = shown.sum(axis=1)
+    confidence = total_shown / (total_shown + ENGAGEMENT_CONFIDENCE_SCALE)
+    return affinity, confidence
+
+# Returns, for each history (one per user), that user's best FEED_SIZE candidates in order
+def rank_candidates(candidates: List[dict], histories: List[dict], limit: int = FEED_SIZE) -> List[List[dict]]:
+    if not candidates:
+        return [[] for _ in histories]
+    sources = sorted({source_key(source_name(c)) for c in candidates})
+    source_columns = {source: column for column, source in enumerate(sources)}
+    recency, completeness, columns = candidate_features(candidates, source_columns)
+    affinity, confidence = affinity_matrix(histories, sources)
+
+    prior = 0.7 * AFFINITY_PRIOR_RATE
+    candidate_affinity = confidence[:, None] * affinity[:, columns] + (1 - confidence[:, None]) * prior
+    scores = (
+        RANKING_WEIGHTS["recency"] * recency[None, :]
+        + RANKING_WEIGHTS["affinity"] * candidate_affinity
+        + RANKING_WEIGHTS["completeness"] * completeness[None, :]
+    )
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :limit]
+    return [[candidates[i] for i in row] for row in order]
+
+def load_engagement(usernames: List[str]) -> dict:
+    docs = resources.engagement_collection.find({"_id": {"$in": usernames}})
+    histories = {doc["_id"]: doc for doc in docs}
+    return {username: histories.get(username, {}) for username in usernames}
+
+# Counts the articles just placed in a user's feed, per source
+def record_articles_shown(username: str, articles: List[dict]):
+    increments = {}
+    for article in articles:
+        field = f"sources.{source_key(article.get('source'))}.shown"
+        increments[field] = increments.get(field, 0) + 1
+    if increments:
+        resources.engagement_collection.update_one({"_id": username}, {"$inc": increments}, upsert=True)
+
+# Records a read, adding only the change in reading time when an article is read again
+def record_article_read(username: str, source: str, newly_read: bool, reading_time_delta: int):
+    key = source_key(source)
+    increments = {f"sources.{key}.readingTime": reading_time_delta}
+    if newly_read:
+        increments[f"sources.{key}.read"] = 1
+    resources.engagement_collection.update_one({"_id": username}, {"$inc": increments}, upsert=True)
+
+# Rate limiting and server errors count as NewsAPI failures; other statuses are returned
+def request_headlines(params: dict):
+    try:
+        with profile_stage("http"):
+            response = requests.get(NEWS_API_URL, params=params, timeout=NEWS_API_TIMEOUT_SECONDS)
+    except requests.RequestException as e:
+        raise UpstreamUnavailableError(f"NewsAPI request failed: {e}")
+    if response.status_code == 429 or response.status_code >= 500:
+        raise UpstreamUnavailableError(f"NewsAPI request failed with status {response.status_code}")
+    return response
+
+# Fetches one large page of headlines and returns the complete, de-duplicated candidates
+def fetch_candidates(preferences: UserPreferences) -> List[dict]:
+    params = {
+        'apiKey': NEWS_API_KEY,
+        'sources': preferences.sources,  # Use the sources parameter
+        'pageSize': NEWS_CANDIDATE_POOL_SIZE,
+    }
 
-        page += 1  # Move to the next page
+    response = news_api_breaker.call(request_headlines, params)
+    if response.status_code != 200:
+        # A rejected request (bad key, bad parameters) says nothing about the news, so the
+        # stored feeds are kept; it is raised outside the breaker, which only tracks outages
+        raise UpstreamUnavailableError(f"NewsAPI request failed with status {response.status_code}")
 
-        # If no new articles were fetched, break the loop to prevent an infinite loop
-        if not new_articles:
-            break
+    # Filter articles to ensure they have complete data
+    candidates = [
+        article for article in response.json().get('articles', [])
+        if all(key in article and article[key] for key in ['title', 'description', 'urlToImage', 'content'])
+    ]
+    # Collapse copies of the same story from different outlets before anything is summarized
+    return collapse_near_duplicates(candidates)
 
-    return articles[:10]
+def fetch_news(preferences: UserPreferences, history: Optional[dict] = None) -> List[dict]:
+    return rank_candidates(fetch_candidates(preferences), [history or {}])[0]
 
 def summarize_article(article: dict, summary_style: str) -> str:
     content = article.get("content", "No content available.")
@@ -172,12 +1348,14 @@ def summarize_article(article: dict, summary_style: str) -> str:
     else:
         prompt = f"Provide a generic summary of this article: {content}"
 
-    chat_completion = grok_client.chat.completions.create(
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        model="llama3-8b-8192",
-    )
+    with governor.admit("groq"):
+        chat_completion = groq_breaker.call(
+            resources.groq_client.chat.completions.create,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            model="llama3-8b-8192",
+        )
 
     response = chat_completion.choices[0].message.content.strip()
 
@@ -221,7 +1399,8 @@ def send_news_summary_email(user_email: str, username: str, articles: List[dict]
     try:
         # Send email using SendGrid
         sg = SendGridAPIClient(sendgrid_api_key)
-        response = sg.send(message)
+        with profile_stage("http"):
+            response = sg.send(message)
         print(f"Email sent to {user_email}. Status Code: {response.status_code}")
         return True
     except Exception as e:
@@ -230,6 +1409,102 @@ def send_news_summary_email(user_email: str, username: str, articles: List[dict]
     
 # All endpoints are added below
 
+def admission_rejected_response(error: AdmissionRejectedError) -> JSONResponse:
+    return JSONResponse(
+        content={"error": "Too many requests, please try again shortly.", "retry_after": math.ceil(error.retry_after)},
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(error.retry_after))},
+    )
+
+# A plain ASGI middleware: requests that are not profiled go straight to the app, with
+# no extra task or body streaming in between (which matters for /audio responses)
+class ProfileMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trigger = should_profile(Request(scope))
+        if not trigger:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"], trigger)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        token = active_profile.set(profile)
+        # The event loop thread is sampled for the whole request; worker threads while they run a stage
+        profile.enter_thread()
+        stack_sampler.start(profile)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            stack_sampler.stop(profile)
+            profile.exit_thread()
+            active_profile.reset(token)
+            task = asyncio.create_task(asyncio.to_thread(save_profile, profile.to_document(status_code)))
+            profile_write_tasks.add(task)
+            task.add_done_callback(profile_write_tasks.discard)
+
+fast_app.add_middleware(ProfileMiddleware)
+
+# Lists recent request profiles, newest first, without their stacks
+@fast_app.get("/admin/profiles")
+async def list_profiles(request: Request, path: Optional[str] = None, limit: int = 50):
+    require_admin(request)
+    query = {"path": {"$regex": f"^{re.escape(path)}"}} if path else {}
+    cursor = resources.profiles_collection.find(query, {"stacks": 0}).sort("$natural", -1).limit(min(max(limit, 1), 500))
+    profiles = await asyncio.to_thread(list, cursor)
+    for profile in profiles:
+        profile["_id"] = str(profile["_id"])
+        profile["started_at"] = profile["started_at"].isoformat()
+    return {"profiles": profiles}
+
+# One request profile including its sampled stacks (collapsed format, outermost frame first)
+@fast_app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    require_admin(request)
+    if not ObjectId.is_valid(profile_id):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    profile = await asyncio.to_thread(resources.profiles_collection.find_one, {"_id": ObjectId(profile_id)})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    profile["_id"] = str(profile["_id"])
+    profile["started_at"] = profile["started_at"].isoformat()
+    return profile
+
+@fast_app.exception_handler(AdmissionRejectedError)
+async def handle_admission_rejected(request: Request, error: AdmissionRejectedError):
+    return admission_rejected_response(error)
+
+# Liveness: the worker process is up and serving requests
+@fast_app.get("/healthz")
+async def liveness():
+    return {"status": "alive", "pid": os.getpid()}
+
+# Readiness: the worker can reach MongoDB and should receive traffic
+@fast_app.get("/readyz")
+async def readiness():
+    try:
+        await asyncio.to_thread(resources.ping)
+    except Exception as e:
+        return JSONResponse(content={"status": "unavailable", "error": str(e)}, status_code=503)
+    if not resources.indexes_ready:
+        # Serving without the unique and TTL indexes would let duplicates and stale data in
+        return JSONResponse(content={"status": "unavailable", "error": "indexes are still being created"}, status_code=503)
+    return {
+        "status": "ready",
+        "pid": os.getpid(),
+        "indexes_ready": resources.indexes_ready,
+        "circuits": {breaker.name: breaker.state for breaker in circuit_breakers},
+    }
+
 @fast_app.get("/status")
 async def get_status(username: str = Cookie(None)):
     if username:
@@ -276,12 +1551,12 @@ async def signup(user: UserCreate):
     hashed_password = hash_password(user.password)
 
      # Check if the email already exists in registered users
-    existing_user = users_collection.find_one({"email": user.email})
+    existing_user = resources.users_collection.find_one({"email": user.email})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered. Please log in, or sign up with a new Email")
 
     # Check if the username already exists
-    existing_user = users_collection.find_one({"username": user.username})
+    existing_user = resources.users_collection.find_one({"username": user.username})
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already exists")
         
@@ -303,7 +1578,7 @@ async def signup(user: UserCreate):
 
     # Try to insert the temporary user into the database
     try:
-        temp_users_collection.insert_one(temp_user)
+        resources.temp_users_collection.insert_one(temp_user)
 
         send_confirmation_email(user.email, confirmation_code)
 
@@ -331,7 +1606,8 @@ def send_confirmation_email(user_email: str, confirmation_code: str):
     try:
         # Send email using SendGrid
         sg = SendGridAPIClient(sendgrid_api_key)
-        response = sg.send(message)
+        with profile_stage("http"):
+            response = sg.send(message)
         print(f"Email sent to {user_email}. Status Code: {response.status_code}")
         return True
     except Exception as e:
@@ -344,7 +1620,7 @@ class VerifyConfirmationCodeRequest(BaseModel):
 
 @fast_app.post("/verify_confirmation")
 async def verify_confirmation(request: VerifyConfirmationCodeRequest):
-    temp_user = temp_users_collection.find_one({"email": request.email})
+    temp_user = resources.temp_users_collection.find_one({"email": request.email})
     if not temp_user:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -362,8 +1638,8 @@ async def verify_confirmation(request: VerifyConfirmationCodeRequest):
 
         # Try to insert the new user into the database
         try:
-            users_collection.insert_one(new_user)
-            temp_users_collection.delete_one({"email": request.email})
+            resources.users_collection.insert_one(new_user)
+            resources.temp_users_collection.delete_one({"email": request.email})
             return {"message": "Account confirmed successfully"}
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error confirming account: {str(e)}")
@@ -372,7 +1648,7 @@ async def verify_confirmation(request: VerifyConfirmationCodeRequest):
 
 @fast_app.post("/login")
 async def login(user: UserLogin):
-    db_user = users_collection.find_one({"username": user.username})
+    db_user = resources.users_collection.find_one({"username": user.username})
     if db_user and db_user["password"] == hash_password(user.password):
         print("Backend login successful for:", user.username)
         now = datetime.now()
@@ -387,29 +1663,10 @@ async def login(user: UserLogin):
 
             # If no last email sent or time since last email exceeds frequency
             if not last_email_sent or (now - last_email_sent).total_seconds() / 3600 >= frequency_hours:
-                # Fetch news articles
-                try:
-                    # Use the existing get_news function to fetch articles
-                    news_response = await get_news(user.username)
-                    articles = news_response.get("articles", [])
-
-                    # Send email if articles exist
-                    if articles:
-                        email_sent = send_news_summary_email(
-                            user_email=db_user["email"],
-                            username=user.username,
-                            articles=articles,
-                            summary_style=db_user["preferences"].get("summaryStyle", "brief")
-                        )
-
-                        # Update last email sent time if email was sent successfully
-                        if email_sent:
-                            users_collection.update_one(
-                                {"username": user.username},
-                                {"$set": {"last_email_sent": now}}
-                            )
-                except Exception as e:
-                    print(f"Error processing news for email: {e}")
+                # The digest is background work, so the login does not wait for it
+                schedule_feed_task(f"digest:{user.username}", lambda: send_digest_in_background(
+                    user.username, db_user["email"], db_user["preferences"].get("summaryStyle", "brief"), now
+                ))
 
         # Rest of your existing login logic remains the same
         if last_login:
@@ -420,7 +1677,7 @@ async def login(user: UserLogin):
                 streak = 0  # Reset streak for missed days
 
         # Update last_login and streak
-        users_collection.update_one(
+        resources.users_collection.update_one(
             {"username": user.username},
             {"$set": {"last_login": now, "streak": streak}}
         )
@@ -495,145 +1752,587 @@ async def login(user: UserLogin):
 async def update_preferences(username: str, preferences: UserPreferences):
     print(f"Attempting to update preferences for username: {username}")
   # Update the user's preferences in the database accordingly
-    result = users_collection.update_one(
+    previous = resources.users_collection.find_one_and_update(
         {"username": username},
-        {"$set": {"preferences": preferences.dict()}}
+        {"$set": {"preferences": preferences.dict()}},
+        projection={"preferences": 1},
+        return_document=ReturnDocument.BEFORE,
     )
     # error handling if prefs are updated successfully
     # if error, user not found displayed
-    print(f"Update result: {result.modified_count}")
-    if result.modified_count:
-        # Construct the path to the audio file
-        audio_dir = os.path.join("src", "audio")
-        final_audio_file = os.path.join(audio_dir, f"{username}_final_podcast_audio.wav")
-
-        # Check if the audio file exists and delete it if it does
-        if os.path.exists(final_audio_file):
-            os.remove(final_audio_file)
-            print(f"Deleted existing audio file: {final_audio_file}")
-        return {"message": "Preferences updated successfully"}
-    raise HTTPException(status_code=404, detail="User not found")
+    if not previous:
+        raise HTTPException(status_code=404, detail="User not found")
 
-@fast_app.get("/news/{username}")
-async def get_news(username: str):
-    user = users_collection.find_one({"username": username})
+    changed_fields = changed_preference_fields(previous.get("preferences"), preferences.dict())
+    print(f"Changed preference fields: {sorted(changed_fields)}")
+    # Articles and summaries are rebuilt lazily by get_news; only the podcast is dropped here
+    if "podcast" in invalidated_artifacts(changed_fields):
+        invalidate_podcast(username)
+    return {"message": "Preferences updated successfully"}
+
+# The entry stored in a user's feed. Without a summary (the LLM failed or ran out of
+# time) the description stands in and "summaryPending" marks it for backfill.
+def feed_entry(article: dict, summary: Optional[str]) -> dict:
+    return {
+        "title": article['title'],
+        "source": article['source']['name'],
+        "description": article['description'],
+        "url": article['url'],
+        "published_at": article.get('publishedAt'),
+        "urlToImage": article.get('urlToImage'),
+        "summary": summary or article['description'],
+        "summaryPending": not summary,
+        "alternateSources": article.get("alternateSources", []),
+        "isRead": False
+    }
+
+def cached_summary(story: Optional[dict], summary_style: str) -> Optional[str]:
+    return ((story or {}).get("summaries") or {}).get(summary_style)
+
+# Summarizes ranked articles into the entries stored in a user's feed
+def summarize_articles(ranked_articles: List[dict], summary_style: str) -> List[dict]:
+    articles = []
+    # Stories already summarized in this style for any user are not sent to the LLM again
+    for article, story in zip(ranked_articles, match_story_index(ranked_articles, summary_style)):
+        summary = cached_summary(story, summary_style)
+        if not summary:
+            try:
+                summary = summarize_article(article, summary_style)
+            except Exception as e:
+                print(f"Summary deferred for {article.get('url')}: {e}")
+        # Recorded even without a summary, so a backfill can use the article content
+        record_story(article, story, summary_style, summary)
+        articles.append(feed_entry(article, summary))
+    return articles
+
+# Builds the stored article entries for a user from freshly fetched NewsAPI articles
+def build_user_articles(username: str, preferences: dict) -> List[dict]:
+    history = load_engagement([username])[username]
+    ranked = fetch_news(UserPreferences(**preferences), history)
+    return summarize_articles(ranked, preferences['summaryStyle'])
+
+# Every write to a news document bumps its "version". Each article records the
+# version it last changed in ("updated_version") and "articles_version" records
+# when the article list itself was last replaced, so clients can sync deltas.
+NEWS_META_PROJECTION = {"articles": 0, "podcast_script": 0}
+
+def next_version_stage() -> dict:
+    return {"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}
+
+# Replaces the user's stored articles; returns the updated document without the articles
+def store_user_articles(username: str, preferences: dict, articles: List[dict]) -> dict:
+    if not articles:
+        # An empty ranking never replaces articles the user already has
+        existing = resources.news_articles_collection.find_one(
+            {"username": username, "articles.0": {"$exists": True}}, NEWS_META_PROJECTION
+        )
+        if existing:
+            return existing
+    record_articles_shown(username, articles)
+    # The podcast is built from the articles, so it is stale once they are replaced
+    invalidate_podcast(username)
+    news_meta = resources.news_articles_collection.find_one_and_update(
+        {"username": username},
+        [
+            next_version_stage(),
+            {"$set": {
+                "username": {"$literal": username},
+                "fetched_at": datetime.now(),
+                "preferences": {"$literal": preferences},
+                "articles": {"$map": {
+                    "input": {"$literal": articles},
+                    "in": {"$mergeObjects": ["$$this", {"updated_version": "$version"}]},
+                }},
+                "articles_version": "$version",
+                "summaries_pending": any(article.get("summaryPending") for article in articles),
+                "podcast_script": "$$REMOVE",
+            }},
+        ],
+        projection=NEWS_META_PROJECTION,
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    request_podcast_pregeneration(username)
+    return news_meta
+
+# Preference-aware invalidation.
+# Each preference field feeds into some of the artifacts kept for a user; an artifact
+# built from another one is invalidated with it. A preference change only rebuilds
+# the artifacts that depend on the fields that actually changed.
+PREFERENCE_ARTIFACTS = {
+    "sources": {"articles"},
+    "country": {"articles"},
+    "category": {"articles"},
+    "summaryStyle": {"summaries", "podcast"},
+    "frequency": {"schedule"},
+}
+ARTIFACT_DEPENDENTS = {
+    "articles": {"summaries", "podcast"},
+    "summaries": {"podcast"},
+}
+
+def changed_preference_fields(old: Optional[dict], new: dict) -> set:
+    old = old or {}
+    return {field for field in set(old) | set(new) if old.get(field) != new.get(field)}
+
+def invalidated_artifacts(changed_fields: set) -> set:
+    stale = set()
+    for field in changed_fields:
+        # A field we know nothing about could affect anything, so rebuild from the articles up
+        stale |= PREFERENCE_ARTIFACTS.get(field, {"articles"})
+    pending = list(stale)
+    while pending:
+        for dependent in ARTIFACT_DEPENDENTS.get(pending.pop(), ()):
+            if dependent not in stale:
+                stale.add(dependent)
+                pending.append(dependent)
+    return stale
+
+def feed_is_expired(news_meta: dict, preferences: dict) -> bool:
+    return datetime.now() - news_meta['fetched_at'] >= timedelta(hours=preferences['frequency'])
+
+def feed_needs_new_articles(news_meta: Optional[dict], preferences: dict) -> bool:
+    if not news_meta:
+        return True
+    stale = invalidated_artifacts(changed_preference_fields(news_meta['preferences'], preferences))
+    return "articles" in stale or feed_is_expired(news_meta, preferences)
+
+def invalidate_podcast(username: str):
+    if audio_storage.delete(podcast_file_name(username)):
+        print(f"Deleted existing podcast audio for: {username}")
+
+# New summaries for the stored articles, reusing the shared story index where possible
+def summarize_stored_articles(articles: List[dict], summary_style: str) -> List[str]:
+    urls = [article["url"] for article in articles]
+    stories = {}
+    projection = {"sources.url": 1, "content": 1, f"summaries.{summary_style}": 1}
+    for story in resources.story_index_collection.find({"sources.url": {"$in": urls}}, projection):
+        for source in story.get("sources", []):
+            stories.setdefault(source.get("url"), story)
+
+    summaries = []
+    for article in articles:
+        story = stories.get(article["url"])
+        summary = ((story or {}).get("summaries") or {}).get(summary_style)
+        if not summary:
+            # The stored feed keeps no article body; fall back to the description once the story expired
+            content = (story or {}).get("content") or article.get("description")
+            summary = summarize_article({"title": article.get("title"), "content": content}, summary_style)
+            if story:
+                resources.story_index_collection.update_one(
+                    {"_id": story["_id"]}, {"$set": {f"summaries.{summary_style}": summary}}
+                )
+        summaries.append(summary)
+    return summaries
+
+# Re-summarizes the stored articles in a new style, keeping the articles and their read state
+def restyle_user_articles(username: str, preferences: dict, news_meta: dict) -> dict:
+    articles = load_user_articles(username)
+    summaries = summarize_stored_articles(articles, preferences['summaryStyle'])
+    updated = resources.news_articles_collection.find_one_and_update(
+        # Only apply if the article list was not replaced while we were summarizing
+        {"username": username, "articles_version": news_meta.get("articles_version")},
+        [
+            next_version_stage(),
+            {"$set": {
+                "preferences": {"$literal": preferences},
+                "podcast_script": "$$REMOVE",
+                "articles": {"$map": {
+                    "input": {"$zip": {"inputs": ["$articles", {"$literal": summaries}]}},
+                    "in": {"$mergeObjects": [
+                        {"$arrayElemAt": ["$$this", 0]},
+                        {"summary": {"$arrayElemAt": ["$$this", 1]}, "summaryPending": False, "updated_version": "$version"},
+                    ]},
+                }},
+            }},
+            {"$set": {"summaries_pending": {"$anyElementTrue": [{"$map": {
+                "input": "$articles",
+                "in": {"$ifNull": ["$$this.summaryPending", False]},
+            }}]}}},
+        ],
+        projection=NEWS_META_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+    invalidate_podcast(username)
+    if updated:
+        request_podcast_pregeneration(username)
+    return updated or resources.news_articles_collection.find_one({"username": username}, NEWS_META_PROJECTION)
+
+# Records preferences that change no stored artifact (e.g. frequency) on the feed
+def update_feed_preferences(username: str, preferences: dict) -> dict:
+    return resources.news_articles_collection.find_one_and_update(
+        {"username": username},
+        {"$set": {"preferences": preferences}},
+        projection=NEWS_META_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+
+def load_user_preferences(username: str) -> dict:
+    user = resources.users_collection.find_one({"username": username}, {"preferences": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     preferences = user.get("preferences")
     if not preferences:
         raise HTTPException(status_code=400, detail="User preferences not set")
+    return preferences
+
+# Makes sure the user's stored feed is current and returns its metadata (without articles)
+def ensure_user_news(username: str) -> dict:
+    preferences = load_user_preferences(username)
+    news_meta = resources.news_articles_collection.find_one({"username": username}, NEWS_META_PROJECTION)
+
+    # Fetch new articles if there are none, the article preferences changed or frequency passed
+    if feed_needs_new_articles(news_meta, preferences):
+        return store_user_articles(username, preferences, build_user_articles(username, preferences))
+
+    # Otherwise rebuild only what the changed preferences affect
+    stale = invalidated_artifacts(changed_preference_fields(news_meta['preferences'], preferences))
+    if "summaries" in stale:
+        return restyle_user_articles(username, preferences, news_meta)
+    if stale:
+        return update_feed_preferences(username, preferences)
+    return news_meta
+
+# Refreshes every stale feed. Users with the same sources share one NewsAPI call,
+# and all of them are ranked together in a single matrix operation.
+def refresh_stale_feeds() -> int:
+    users = list(resources.users_collection.find({"preferences": {"$exists": True}}, {"username": 1, "preferences": 1}))
+    metas = {
+        doc["username"]: doc
+        for doc in resources.news_articles_collection.find(
+            {"username": {"$in": [user["username"] for user in users]}}, NEWS_META_PROJECTION
+        )
+    }
+    groups = {}
+    for user in users:
+        preferences = user["preferences"]
+        news_meta = metas.get(user["username"])
+        if feed_needs_new_articles(news_meta, preferences):
+            groups.setdefault(preferences.get("sources"), []).append(user)
+        elif news_meta['preferences'] != preferences:
+            try:
+                ensure_user_news(user["username"])
+            except Exception as e:
+                print(f"Error refreshing feed for {user['username']}: {e}")
+
+    refreshed = 0
+    for group in groups.values():
+        usernames = [user["username"] for user in group]
+        try:
+            candidates = fetch_candidates(UserPreferences(**group[0]["preferences"]))
+        except UpstreamUnavailableError as e:
+            # Keep the stored feeds; the next run tries again
+            print(f"Skipping refresh of {len(group)} feeds: {e}")
+            continue
+        histories = load_engagement(usernames)
+        rankings = rank_candidates(candidates, [histories[username] for username in usernames])
+        for user, ranked in zip(group, rankings):
+            preferences = user["preferences"]
+            try:
+                store_user_articles(user["username"], preferences, summarize_articles(ranked, preferences["summaryStyle"]))
+                refreshed += 1
+            except Exception as e:
+                print(f"Error refreshing feed for {user['username']}: {e}")
+    return refreshed
+
+async def run_feed_refresher():
+    work_priority.set(WORK_BACKGROUND)
+    while True:
+        await asyncio.sleep(FEED_REFRESH_INTERVAL_SECONDS)
+        try:
+            refreshed = await run_blocking(refresh_stale_feeds)
+            if refreshed:
+                print(f"Refreshed {refreshed} stale feeds")
+        except Exception as e:
+            print(f"Error refreshing feeds: {e}")
+
+def load_user_articles(username: str) -> List[dict]:
+    doc = resources.news_articles_collection.find_one({"username": username}, {"_id": 0, "articles": 1})
+    return doc.get("articles", []) if doc else []
+
+# Only the articles whose content or read state changed after the given version
+def load_changed_articles(username: str, since: int) -> List[dict]:
+    result = list(resources.news_articles_collection.aggregate([
+        {"$match": {"username": username}},
+        {"$project": {"_id": 0, "articles": {"$filter": {
+            "input": "$articles",
+            "cond": {"$gt": [{"$ifNull": ["$$this.updated_version", 0]}, since]},
+        }}}},
+    ]))
+    return result[0]["articles"] if result else []
+
+def feed_etag(news_meta: dict) -> str:
+    # The document id changes if the feed is deleted and recreated, the version on every write
+    return f'"{news_meta["_id"]}-{news_meta.get("version", 0)}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+# Latency SLO mode.
+# A stored feed is served immediately while it is refreshed in the background
+# (stale-while-revalidate). A user without a servable feed gets one built within
+# FEED_DEADLINE_SECONDS: summaries still missing at the deadline are filled with the
+# article description and backfilled asynchronously.
+feed_background_tasks = {}
+
+def schedule_feed_task(key: str, make_coroutine):
+    # At most one background job per key (a username, "podcast:<username>" or "digest:<username>") in this process
+    running = feed_background_tasks.get(key)
+    if running and not running.done():
+        return running
+    task = asyncio.create_task(make_coroutine())
+    feed_background_tasks[key] = task
+
+    def forget(done_task):
+        if feed_background_tasks.get(key) is done_task:
+            feed_background_tasks.pop(key, None)
+    task.add_done_callback(forget)
+    return task
+
+# Writes the given url -> summary results into the stored feed
+def apply_backfilled_summaries(username: str, articles_version, filled: List[dict]):
+    if not filled:
+        return
+    resources.news_articles_collection.update_one(
+        {"username": username, "articles_version": articles_version},
+        [
+            next_version_stage(),
+            {"$set": {"articles": {"$map": {
+                "input": "$articles",
+                "in": {"$let": {
+                    "vars": {"match": {"$arrayElemAt": [{"$filter": {
+                        "input": {"$literal": filled},
+                        "as": "filled",
+                        "cond": {"$eq": ["$$filled.url", "$$this.url"]},
+                    }}, 0]}},
+                    "in": {"$cond": [
+                        {"$ifNull": ["$$match", False]},
+                        {"$mergeObjects": ["$$this", {"summary": "$$match.summary", "summaryPending": False, "updated_version": "$version"}]},
+                        "$$this",
+                    ]},
+                }},
+            }}}},
+            {"$set": {"summaries_pending": {"$anyElementTrue": [{"$map": {
+                "input": "$articles",
+                "in": {"$ifNull": ["$$this.summaryPending", False]},
+            }}]}}},
+        ],
+    )
 
-    user_news_doc = news_articles_collection.find_one({"username": username})
+# Summarizes every article still marked "summaryPending" in the stored feed
+def backfill_pending_summaries(username: str) -> int:
+    doc = resources.news_articles_collection.find_one(
+        {"username": username}, {"articles": 1, "preferences": 1, "articles_version": 1}
+    )
+    pending = [article for article in (doc or {}).get("articles", []) if article.get("summaryPending")]
+    if not pending:
+        return 0
+    filled = []
+    for article in pending:
+        try:
+            summary = summarize_stored_articles([article], doc["preferences"]["summaryStyle"])[0]
+        except Exception as e:
+            print(f"Backfill for {article['url']} failed: {e}")
+            continue
+        filled.append({"url": article["url"], "summary": summary})
+    apply_backfilled_summaries(username, doc.get("articles_version"), filled)
+    return len(filled)
+
+async def refresh_feed_in_background(username: str):
+    work_priority.set(WORK_BACKGROUND)
+    try:
+        await run_blocking(ensure_user_news, username)
+        await run_blocking(backfill_pending_summaries, username)
+    except Exception as e:
+        print(f"Background refresh for {username} failed: {e}")
 
-    # Check if the preferences have changed (e.g., compare the stored preferences with the current ones)
-    if user_news_doc and user_news_doc['preferences'] == preferences:
-        if datetime.now() - user_news_doc['fetched_at'] < timedelta(hours=preferences['frequency']):
-            # Return the stored articles if they are recent enough
-            articles = user_news_doc['articles']
-        else:
-            # Fetch new articles if the frequency has passed
-            fetched_articles = fetch_news(UserPreferences(**preferences))
-            articles = []
-            for article in fetched_articles:
-                summary = summarize_article(article, preferences['summaryStyle'])
-                articles.append({
-                    "title": article['title'],
-                    "source": article['source']['name'],
-                    "description": article['description'],
-                    "url": article['url'],
-                    "published_at": article.get('publishedAt'),
-                    "urlToImage": article.get('urlToImage'),
-                    "summary": summary,
-                    "isRead": False 
-                })
-
-            # Update the user's document with the new articles
-            news_articles_collection.update_one(
-                {"username": username},
-                {
-                    "$set": {
-                        "username": username,
-                        "fetched_at": datetime.now(),
-                        "preferences": preferences,
-                        "articles": articles
-                    }
-                },
-                upsert=True
-            )
-    else:
-        # If preferences have changed, fetch new articles regardless of frequency
-        fetched_articles = fetch_news(UserPreferences(**preferences))
-        articles = []
-        for article in fetched_articles:
-            summary = summarize_article(article, preferences['summaryStyle'])
-            articles.append({
-                "title": article['title'],
-                "source": article['source']['name'],
-                "description": article['description'],
-                "url": article['url'],
-                "published_at": article.get('publishedAt'),
-                "urlToImage": article.get('urlToImage'),
-                "summary": summary,
-                "isRead": False
-            })
-
-        # Update the user's document with the new articles and preferences
-        news_articles_collection.update_one(
-            {"username": username},
-            {
-                "$set": {
-                    "username": username,
-                    "fetched_at": datetime.now(),
-                    "preferences": preferences,
-                    "articles": articles
-                }
-            },
-            upsert=True
+# Brings the user's feed up to date and emails it; queues behind interactive requests for LLM capacity
+async def send_digest_in_background(username: str, user_email: str, summary_style: str, now: datetime):
+    work_priority.set(WORK_BACKGROUND)
+    work_username.set(username)
+    try:
+        # Make sure the stored feed is current, then load its articles
+        await run_blocking(ensure_user_news, username)
+        articles = await run_blocking(load_user_articles, username)
+
+        # Send email if articles exist
+        if articles:
+            email_sent = await run_blocking(send_news_summary_email, user_email, username, articles, summary_style)
+
+            # Update last email sent time if email was sent successfully
+            if email_sent:
+                await run_blocking(
+                    resources.users_collection.update_one,
+                    {"username": username},
+                    {"$set": {"last_email_sent": now}},
+                )
+    except Exception as e:
+        print(f"Error processing news for email: {e}")
+
+# Waits for summaries that missed the deadline, then backfills whatever is still pending.
+# in_flight holds (article, story, task) for each summary still running at the deadline.
+async def finish_summaries_in_background(username: str, articles_version, summary_style: str, in_flight: List[tuple]):
+    work_priority.set(WORK_BACKGROUND)
+    try:
+        if in_flight:
+            await asyncio.wait([task for _, _, task in in_flight])
+        finished = [
+            (article, story, task.result())
+            for article, story, task in in_flight
+            if not task.cancelled() and task.exception() is None and task.result()
+        ]
+        # The story index only got these articles without a summary, so other users can reuse them now
+        await run_blocking(
+            record_summarized_stories,
+            [article for article, _, _ in finished],
+            [story for _, story, _ in finished],
+            summary_style,
+            [summary for _, _, summary in finished],
+        )
+        filled = [{"url": article["url"], "summary": summary} for article, _, summary in finished]
+        await run_blocking(apply_backfilled_summaries, username, articles_version, filled)
+        await run_blocking(backfill_pending_summaries, username)
+    except Exception as e:
+        print(f"Summary backfill for {username} failed: {e}")
+
+def record_summarized_stories(ranked: List[dict], stories: List[Optional[dict]], summary_style: str, summaries: List[Optional[str]]):
+    for article, story, summary in zip(ranked, stories, summaries):
+        record_story(article, story, summary_style, summary)
+
+async def build_feed_within_deadline(username: str, preferences: dict) -> dict:
+    deadline = time.monotonic() + FEED_DEADLINE_SECONDS
+    summary_style = preferences['summaryStyle']
+    try:
+        history = (await asyncio.to_thread(load_engagement, [username]))[username]
+        ranked = await asyncio.wait_for(
+            asyncio.to_thread(fetch_news, UserPreferences(**preferences), history),
+            timeout=max(deadline - time.monotonic(), 0),
         )
+    except (asyncio.TimeoutError, UpstreamUnavailableError) as e:
+        print(f"Could not fetch news for {username} within the deadline: {e}")
+        raise HTTPException(status_code=503, detail="News is temporarily unavailable, please try again shortly")
+
+    stories = await asyncio.to_thread(match_story_index, ranked, summary_style)
+    summaries = [cached_summary(story, summary_style) for story in stories]
+    tasks = {
+        index: asyncio.create_task(asyncio.to_thread(summarize_article, article, summary_style))
+        for index, article in enumerate(ranked)
+        if not summaries[index]
+    }
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=max(deadline - time.monotonic(), 0))
+    in_flight = []
+    for index, task in tasks.items():
+        if task.done() and not task.cancelled() and task.exception() is None:
+            summaries[index] = task.result()
+        elif not task.done():
+            in_flight.append((ranked[index], stories[index], task))
+
+    await asyncio.to_thread(record_summarized_stories, ranked, stories, summary_style, summaries)
+    entries = [feed_entry(article, summary) for article, summary in zip(ranked, summaries)]
+    news_meta = await asyncio.to_thread(store_user_articles, username, preferences, entries)
+    if news_meta.get("summaries_pending"):
+        articles_version = news_meta.get("articles_version")
+        schedule_feed_task(username, lambda: finish_summaries_in_background(username, articles_version, summary_style, in_flight))
+    return news_meta
+
+# Returns the feed to serve and whether it is stale
+async def load_feed_within_slo(username: str):
+    preferences = await asyncio.to_thread(load_user_preferences, username)
+    news_meta = await asyncio.to_thread(
+        resources.news_articles_collection.find_one, {"username": username}, NEWS_META_PROJECTION
+    )
+    # A feed built for other sources is not worth serving, even stale
+    if not news_meta or "articles" in invalidated_artifacts(changed_preference_fields(news_meta['preferences'], preferences)):
+        return await build_feed_within_deadline(username, preferences), False
 
-    return {"articles": articles}
+    if feed_is_expired(news_meta, preferences) or news_meta['preferences'] != preferences:
+        schedule_feed_task(username, lambda: refresh_feed_in_background(username))
+        return news_meta, True
+    if news_meta.get("summaries_pending"):
+        schedule_feed_task(username, lambda: refresh_feed_in_background(username))
+    return news_meta, False
+
+@fast_app.get("/news/{username}")
+async def get_news(username: str, request: Request, since: Optional[int] = None):
+    work_username.set(username)
+    stale = False
+    if FEED_SLO_MODE:
+        news_meta, stale = await load_feed_within_slo(username)
+    else:
+        try:
+            news_meta = await asyncio.to_thread(ensure_user_news, username)
+        except UpstreamUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    version = news_meta.get("version", 0)
+    headers = {"ETag": feed_etag(news_meta), "Cache-Control": "no-cache"}
+    if stale:
+        headers["X-Feed-Stale"] = "true"
+
+    # Nothing changed since the client's copy: no articles are loaded or serialized
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    # Delta sync: valid only while the article list the client holds is still the stored one
+    if since is not None and news_meta.get("articles_version", 0) <= since <= version:
+        changes = await asyncio.to_thread(load_changed_articles, username, since)
+        return JSONResponse(content={"version": version, "full": False, "changes": changes}, headers=headers)
+
+    articles = await asyncio.to_thread(load_user_articles, username)
+    return JSONResponse(content={"articles": articles, "version": version, "full": True}, headers=headers)
 
 @fast_app.patch("/news/{username}/mark_as_read")
 async def mark_article_as_read(username: str, article_url: str, readingTime: int = 0):
     # Find the user
-    user = users_collection.find_one({"username": username})
+    user = resources.users_collection.find_one({"username": username}, {"_id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    # Find the user's news document
-    user_news_doc = news_articles_collection.find_one({"username": username})
-    if not user_news_doc:
-        raise HTTPException(status_code=404, detail="No news data found for this user")
 
-    # Update the "isRead" state for the specific article
-    updated_articles = []
-    for article in user_news_doc["articles"]:
-        if article["url"] == article_url:
-            article["isRead"] = True  # Mark as read
-            article["readingTime"] = readingTime
-        updated_articles.append(article)
-    
-    # Update the document with the new "isRead" state
-    news_articles_collection.update_one(
-        {"username": username},
-        {
-            "$set": {
-                "articles": updated_articles
-            }
-        }
+    # Update the "isRead" state for the specific article in place, bumping the feed version
+    previous = resources.news_articles_collection.find_one_and_update(
+        {"username": username, "articles.url": article_url},
+        [
+            next_version_stage(),
+            {"$set": {"articles": {"$map": {
+                "input": "$articles",
+                "in": {"$cond": [
+                    {"$eq": ["$$this.url", {"$literal": article_url}]},
+                    {"$mergeObjects": ["$$this", {"isRead": True, "readingTime": readingTime, "updated_version": "$version"}]},
+                    "$$this",
+                ]},
+            }}}},
+        ],
+        projection={"articles": {"$elemMatch": {"url": article_url}}},
+        return_document=ReturnDocument.BEFORE,
     )
+    if not previous:
+        # Find the user's news document
+        if not resources.news_articles_collection.count_documents({"username": username}, limit=1):
+            raise HTTPException(status_code=404, detail="No news data found for this user")
+    else:
+        # Feed the ranker's per-source engagement history
+        article = previous["articles"][0]
+        record_article_read(
+            username,
+            article.get("source"),
+            newly_read=not article.get("isRead"),
+            reading_time_delta=readingTime - article.get("readingTime", 0),
+        )
 
     return {"message": "Article marked as read", "url": article_url}
 
 @fast_app.get("/news/{username}/statistics")
 async def get_news_statistics(username: str):
-    user = users_collection.find_one({"username": username})
+    user = resources.users_collection.find_one({"username": username})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Fetch the user's news data
-    user_news_doc = news_articles_collection.find_one({"username": username})
+    user_news_doc = resources.news_articles_collection.find_one({"username": username})
     if not user_news_doc:
         raise HTTPException(status_code=404, detail="No news data found for this user")
     
@@ -655,7 +2354,7 @@ async def get_news_statistics(username: str):
 # Endpoint to get preferences for the Profile Page display
 @fast_app.get("/user/{username}", response_model=UserPreferencesResponse)
 async def get_user_preferences(username: str):
-    user = users_collection.find_one({"username": username})
+    user = resources.users_collection.find_one({"username": username})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return {"username": user["username"], "preferences": user.get("preferences", {})}
@@ -664,7 +2363,7 @@ async def get_user_preferences(username: str):
 @fast_app.put("/user/{username}/password")
 async def update_user_password(username: str, request: UpdatePasswordRequest):
     # Fetch user from the database
-    user = users_collection.find_one({"username": username})
+    user = resources.users_collection.find_one({"username": username})
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -677,7 +2376,7 @@ async def update_user_password(username: str, request: UpdatePasswordRequest):
     hashed_password = hash_password(request.new_password)
 
     # Update the password in the database
-    result = users_collection.update_one(
+    result = resources.users_collection.update_one(
         {"username": username},
         {"$set": {"password": hashed_password}}
     )
@@ -690,7 +2389,7 @@ async def update_user_password(username: str, request: UpdatePasswordRequest):
 # Endpoint to get all news articles stored in the database
 @fast_app.get("/news_articles/")
 async def get_news_articles():
-    articles = list(news_articles_collection.find())
+    articles = list(resources.news_articles_collection.find())
     # for mongoDB : Change the news ObjectIds to string same as endpoint 4
     for article in articles:
         article["_id"] = str(article["_id"])
@@ -700,10 +2399,12 @@ async def get_news_articles():
 @fast_app.delete("/user/{username}")
 async def delete_user(username: str):
     # if user is found in db, delete from the database
-    result = users_collection.delete_one({"username": username})
+    result = resources.users_collection.delete_one({"username": username})
     if result.deleted_count:
-      # delete the news articles as well
-        news_articles_collection.delete_many({"username": username})
+      # delete the news articles and podcast as well
+        resources.news_articles_collection.delete_many({"username": username})
+        audio_storage.delete(podcast_file_name(username))
+        resources.engagement_collection.delete_one({"_id": username})
         return {"message": f"User {username} and articles associated with the account are deleted"}
     # error handling part when the user is not found
     raise HTTPException(status_code=404, detail="User not found")
@@ -739,20 +2440,25 @@ async def generate_podcast_script(articles, summary_style, username):
             f"Ensure the podcast fits within 2 minutes (~300 words), sounds like it’s delivered by a charismatic and lively host."
         )
 
-        # OpenAI API call using the updated syntax
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo", 
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant writing podcast scripts."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=300,
-            temperature=0.7
-        )
+        # OpenAI API call using the updated syntax, run in a thread so queueing never blocks the event loop
+        def create_script():
+            with governor.admit("openai_chat"):
+                return resources.openai_client.chat.completions.create(
+                    model="gpt-3.5-turbo", 
+                    messages=[
+                        {"role": "system", "content": "You are a helpful assistant writing podcast scripts."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=300,
+                    temperature=0.7
+                )
+        response = await run_blocking(create_script)
 
         podcast_text = response.choices[0].message.content.strip()
         #print("Generated Podcast Script:", podcast_text)
         return podcast_text
+    except AdmissionRejectedError:
+        raise
     except Exception as e:
         print("Error during podcast script generation:", e)
         raise HTTPException(status_code=500, detail="An error occurred while generating the podcast script.")
@@ -763,11 +2469,14 @@ async def generate_podcast_audio(script):
         podcast_audio_path = os.path.join(audio_directory, f"podcast_audio_{timestamp}.mp3")
 
         # OpenAI API for text-to-speech (TTS)
-        response = openai.audio.speech.create(
-            model="tts-1",
-            voice="alloy", 
-            input=script
-        )
+        def create_speech():
+            with governor.admit("openai_tts"):
+                return resources.openai_client.audio.speech.create(
+                    model="tts-1",
+                    voice="alloy", 
+                    input=script
+                )
+        response = await run_blocking(create_speech)
         print("TTS Response:", response)
 
         with open(podcast_audio_path, "wb") as f:
@@ -775,64 +2484,273 @@ async def generate_podcast_audio(script):
 
         print(f"Generated audio saved at: {podcast_audio_path}")
         return podcast_audio_path
+    except AdmissionRejectedError:
+        raise
     except Exception as e:
         print("Error during TTS conversion:", e)
         raise HTTPException(status_code=500, detail="An error occurred while converting text to speech.")
 
-async def add_intro_outro_music(audio_path, music_path, username):
+# Podcast pre-generation.
+# When PODCAST_PREGENERATION is "script" (or "audio"), every feed refresh is followed by
+# a low-priority background job that drafts the podcast script for the new articles
+# (and, for "audio", also synthesizes and mixes the audio). The script is cached on the
+# news document together with the articles_version and summary style it was made for,
+# so replacing the articles or changing the style invalidates it. Opening the podcast
+# then only needs the cached script, or nothing at all when the audio is ready.
+podcast_pregeneration_slots = None
+# Users whose pre-generation job should stop after its current stage
+dropped_podcast_jobs = set()
+
+def cached_podcast_script(news_doc: Optional[dict], summary_style: str) -> Optional[str]:
+    cached = (news_doc or {}).get("podcast_script")
+    if cached and cached.get("articles_version") == news_doc.get("articles_version") and cached.get("summary_style") == summary_style:
+        return cached.get("text")
+    return None
+
+def store_podcast_script(username: str, articles_version, summary_style: str, script: str):
+    # Only attach the script if the articles it was written for are still the stored ones
+    resources.news_articles_collection.update_one(
+        {"username": username, "articles_version": articles_version},
+        {"$set": {"podcast_script": {
+            "text": script,
+            "articles_version": articles_version,
+            "summary_style": summary_style,
+            "created_at": datetime.now(),
+        }}},
+    )
+
+# Returns the cached script for the user's current articles, drafting and caching it if needed
+async def load_or_generate_podcast_script(username: str, news_doc: dict, summary_style: str) -> str:
+    script = cached_podcast_script(news_doc, summary_style)
+    if script:
+        return script
+    script = await generate_podcast_script(news_doc["articles"], summary_style, username)
+    await run_blocking(store_podcast_script, username, news_doc.get("articles_version"), summary_style, script)
+    return script
+
+async def pregenerate_podcast(username: str):
+    global podcast_pregeneration_slots
+    work_priority.set(WORK_BACKGROUND)
+    work_username.set(username)
+    if podcast_pregeneration_slots is None:
+        podcast_pregeneration_slots = asyncio.Semaphore(PODCAST_PREGENERATION_CONCURRENCY)
+    dropped_podcast_jobs.discard(username)
     try:
-        audio_directory = "src/audio"
-        os.makedirs(audio_directory, exist_ok=True)
+        async with podcast_pregeneration_slots:
+            if username in dropped_podcast_jobs:
+                return
+            news_doc = await run_blocking(
+                resources.news_articles_collection.find_one,
+                {"username": username},
+                {"articles": 1, "preferences": 1, "articles_version": 1, "podcast_script": 1},
+            )
+            if not news_doc or not news_doc.get("articles"):
+                return
+            summary_style = news_doc["preferences"].get("summaryStyle", "brief")
+            # The script is cached as soon as it exists, so it is kept even if the job is dropped
+            script = await load_or_generate_podcast_script(username, news_doc, summary_style)
+
+            if PODCAST_PREGENERATION != "audio" or username in dropped_podcast_jobs:
+                return
+            if await run_blocking(audio_storage.exists, podcast_file_name(username)):
+                return
+            audio_path = await generate_podcast_audio(script)
+            if username in dropped_podcast_jobs:
+                await run_blocking(os.remove, audio_path)
+                return
+            await add_intro_outro_music(audio_path, "podcast_intro.wav", username)
+            # Drop the audio if the articles were replaced while it was being made
+            current = await run_blocking(
+                resources.news_articles_collection.find_one, {"username": username}, {"articles_version": 1}
+            )
+            if not current or current.get("articles_version") != news_doc.get("articles_version"):
+                await run_blocking(invalidate_podcast, username)
+    except Exception as e:
+        print(f"Podcast pre-generation for {username} failed: {getattr(e, 'detail', e)}")
+    finally:
+        dropped_podcast_jobs.discard(username)
+
+# Safe to call from the event loop or from a worker thread
+def request_podcast_pregeneration(username: str):
+    if PODCAST_PREGENERATION not in ("script", "audio") or event_loop is None:
+        return
 
-        if audio_path.endswith(".mp3"):
-            wav_audio_path = os.path.join(audio_directory, f"{username}_podcast_audio.wav")
-            AudioSegment.from_file(audio_path, format="mp3").export(wav_audio_path, format="wav")
-            audio_path = wav_audio_path
+    def schedule():
+        schedule_feed_task(f"podcast:{username}", lambda: pregenerate_podcast(username))
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is event_loop:
+        schedule()
+    else:
+        event_loop.call_soon_threadsafe(schedule)
 
-        music_file_path = os.path.join(audio_directory, music_path)
-        podcast_audio = AudioSegment.from_file(audio_path, format="wav")
-        background_music = AudioSegment.from_file(music_file_path, format="wav")
+# pydub decoding and mixing (ffmpeg) and the storage upload block, so they run in a thread
+async def add_intro_outro_music(audio_path, music_path, username):
+    return await run_blocking(mix_intro_outro_music, audio_path, music_path, username)
 
-        intro_music = background_music[:10000].fade_in(3000) - 20
-        outro_music = background_music[:10000].fade_out(3000) - 20
+def mix_intro_outro_music(audio_path, music_path, username):
+    intermediates = [audio_path]
+    try:
+        resources.ensure_audio_tools()
+        audio_directory = "src/audio"
+        os.makedirs(audio_directory, exist_ok=True)
 
-        combined_audio = intro_music + podcast_audio.fade_in(3000).fade_out(3000) + outro_music
-        final_audio_path = os.path.join(audio_directory, f"{username}_final_podcast_audio.wav")
-        combined_audio.export(final_audio_path, format="wav")
+        with profile_stage("audio"):
+            if audio_path.endswith(".mp3"):
+                wav_audio_path = os.path.join(audio_directory, f"{username}_tts_{int(time.time())}.wav")
+                AudioSegment.from_file(audio_path, format="mp3").export(wav_audio_path, format="wav")
+                audio_path = wav_audio_path
+                intermediates.append(wav_audio_path)
+
+            music_file_path = os.path.join(audio_directory, music_path)
+            podcast_audio = AudioSegment.from_file(audio_path, format="wav")
+            background_music = AudioSegment.from_file(music_file_path, format="wav")
+
+            intro_music = background_music[:10000].fade_in(3000) - 20
+            outro_music = background_music[:10000].fade_out(3000) - 20
+
+            combined_audio = intro_music + podcast_audio.fade_in(3000).fade_out(3000) + outro_music
+            # Mix into a private temp file, then hand it to storage
+            with tempfile.NamedTemporaryFile(prefix=f"{username}_mix_", suffix=".wav", dir=audio_directory, delete=False) as mixed:
+                mixed_path = mixed.name
+            intermediates.append(mixed_path)
+            combined_audio.export(mixed_path, format="wav")
+        with profile_stage("storage"):
+            audio_storage.save(podcast_file_name(username), mixed_path)
 
         # Return the relative URL for the generated file
-        return f"/audio/{username}_final_podcast_audio.wav"
+        return f"/audio/{podcast_file_name(username)}"
     except Exception as e:
         print("Error adding intro/outro music:", e)
         raise HTTPException(status_code=500, detail="Error adding intro/outro music.")
+    finally:
+        # Intermediates are never served; anything left behind by a crash is removed by the audio GC
+        for path in intermediates:
+            if os.path.exists(path):
+                os.remove(path)
+
+AUDIO_MEDIA_TYPES = {".wav": "audio/wav", ".mp3": "audio/mpeg"}
+
+
+# Parses a single "bytes=start-end" range; returns None when the header should be ignored
+def parse_byte_range(range_header: str, size: int):
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    start, end = match.group(1), match.group(2)
+    if not start:
+        # Suffix range: the last N bytes (an empty suffix selects nothing and is ignored)
+        length = int(end)
+        if length == 0 or size == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        # "bytes=5-3" is not a valid range, so the whole file is served
+        return None
+    end = min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+def iter_file_range(path: str, start: int, end: int, chunk_size: int = 64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# Serves podcast audio from the configured storage with ETag and Range support
+@fast_app.api_route("/audio/{filename}", methods=["GET", "HEAD"])
+async def serve_audio(filename: str, request: Request):
+    if not AUDIO_NAME_RE.match(filename) or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    blob = await asyncio.to_thread(audio_storage.stat, filename)
+    if not blob:
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    etag = f'"{blob.etag}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-cache",
+        "Last-Modified": format_datetime(blob.modified_at, usegmt=True),
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = AUDIO_MEDIA_TYPES.get(os.path.splitext(filename)[1], "application/octet-stream")
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_byte_range(range_header, blob.size)
+        if byte_range and byte_range[0] >= blob.size:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{blob.size}"})
+
+    start, end = byte_range if byte_range else (0, blob.size - 1)
+    headers["Content-Length"] = str(max(end - start + 1, 0))
+    status_code = 200
+    if byte_range:
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{blob.size}"
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+
+    path = await asyncio.to_thread(audio_storage.local_path, filename)
+    if not path:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    return StreamingResponse(iter_file_range(path, start, end), status_code=status_code, headers=headers, media_type=media_type)
 
 @fast_app.get("/podcast_script/{username}")
 async def create_podcast_script(username: str):
     try:
-        audio_dir = os.path.join("src", "audio")
-        final_audio_file = os.path.join(audio_dir, f"{username}_final_podcast_audio.wav")
-
-        # Check if the final audio file already exists
-        if os.path.exists(final_audio_file):
-            audio_url = f"/audio/{username}_final_podcast_audio.wav"
+        # Take over a pre-generation job still running for this user: it is lifted to interactive
+        # priority and awaited, so the script and audio it is paying for are used. If it takes too
+        # long (e.g. queued behind other users' jobs) it stops after its current stage and the
+        # podcast is made here, reusing the script if the job already cached it.
+        pregeneration = feed_background_tasks.get(f"podcast:{username}")
+        if pregeneration and not pregeneration.done():
+            users_awaiting_background_work.add(username)
+            try:
+                await asyncio.wait_for(asyncio.shield(pregeneration), PODCAST_TAKEOVER_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                dropped_podcast_jobs.add(username)
+            finally:
+                users_awaiting_background_work.discard(username)
+
+        # Check if the final audio file already exists (on any node when storage is shared)
+        if await asyncio.to_thread(audio_storage.exists, podcast_file_name(username)):
+            audio_url = f"/audio/{podcast_file_name(username)}"
             print(audio_url)
             return JSONResponse(content={"audio_url": audio_url})
 
         # Fetch user preferences (simulate database calls)
-        user = users_collection.find_one({"username": username})
+        user = resources.users_collection.find_one({"username": username})
         if not user:
             raise HTTPException(status_code=404, detail="User not found.")
 
-        user_news = news_articles_collection.find_one({"username": username})
+        user_news = resources.news_articles_collection.find_one({"username": username})
         if not user_news or not user_news.get("articles"):
             raise HTTPException(status_code=404, detail="No articles found for this user.")
 
-        articles = user_news["articles"]
         preferences = user.get("preferences", {})
         summary_style = preferences.get("summaryStyle", "brief")
 
-        # Generate podcast script asynchronously and wait for it to complete
-        podcast_script = await generate_podcast_script(articles, summary_style, username)
+        # Each generation costs a script and a TTS call, so users get a limited number per hour
+        work_username.set(username)
+        await asyncio.to_thread(governor.check_user_action, username, "podcast")
+
+        # Use the script drafted after the last feed refresh, or generate it now
+        podcast_script = await load_or_generate_podcast_script(username, user_news, summary_style)
 
         # Generate audio for the podcast script asynchronously and wait for it to complete
         audio_path = await generate_podcast_audio(podcast_script)
@@ -849,6 +2767,8 @@ async def create_podcast_script(username: str):
     except HTTPException as e:
         print(f"Error in podcast script endpoint: {e.detail}")
         return JSONResponse(content={"error": e.detail}, status_code=e.status_code)
+    except AdmissionRejectedError as e:
+        return admission_rejected_response(e)
     except Exception as e:
         print("Unexpected error in podcast script endpoint:", e)
         return JSONResponse(content={"error": "An unexpected error occurred."}, status_code=500)
@@ -856,12 +2776,12 @@ async def create_podcast_script(username: str):
 # Complete the points update endpoint
 @fast_app.post("/points/update")
 async def update_user_points(username: str, points: int):
-    user = users_collection.find_one({"username": username})
+    user = resources.users_collection.find_one({"username": username})
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
     # Update user points in the database
     new_points = user["points"] + points
-    users_collection.update_one(
+    resources.users_collection.update_one(
         {"username": username},
         {"$set": {"points": new_points}}
     )
@@ -870,14 +2790,14 @@ async def update_user_points(username: str, points: int):
 # New endpoint to fetch current points
 @fast_app.get("/points/{username}")
 async def get_user_points(username: str):
-    user = users_collection.find_one({"username": username}, {"_id": 0, "points": 1})
+    user = resources.users_collection.find_one({"username": username}, {"_id": 0, "points": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
     return {"username": username, "points": user["points"]}
 
 @fast_app.get("/streak/{username}")
 async def get_streak(username: str):
-    user = users_collection.find_one({"username": username})
+    user = resources.users_collection.find_one({"username": username})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return {"streak": user.get("streak", 0)}
@@ -892,4 +2812,9 @@ fast_app.add_middleware(
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(fast_app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        # Multiple workers need an import string so each process builds its own app and clients
+        uvicorn.run("api:fast_app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(fast_app, host="0.0.0.0", port=8000)
\ No newline at end of file